@@ -7,20 +7,22 @@ from __future__ import unicode_literals
 import yt_dlp
 import ffmpeg
 import argparse
+import asyncio
 import json
 import os
 import sys
 import tempfile
+import threading
 from datetime import timedelta
 from pathlib import Path
 import time
+from typing import Iterator
 
-import librosa
+import ctranslate2
 import pandas as pd
 from dotenv import load_dotenv
 
-# from utils.inference_model import whisper_inference_model
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 from loguru import logger
 from moviepy.editor import VideoFileClip
 from rich.progress import track
@@ -34,7 +36,14 @@ from telegram.ext import (
 )
 
 from utils.save_users import save_user
-from utils.utils import format_timedelta, split_string
+from utils.utils import (
+    WHISPER_SR,
+    decode_audio,
+    format_timedelta,
+    get_message_info,
+    load_audio,
+    split_string,
+)
 
 load_dotenv()
 parser = argparse.ArgumentParser()
@@ -45,7 +54,21 @@ parser.add_argument(
     default=False,
     help="Set it to True to enable verbose mode",
 )
+parser.add_argument(
+    "-b",
+    "--backend",
+    choices=["faster-whisper", "transformers"],
+    default="faster-whisper",
+    help="Whisper implementation used for the transcriptions",
+)
+parser.add_argument(
+    "--load-in-8bit",
+    action="store_true",
+    help="Load the transformers model with 8-bit weights, needs bitsandbytes and accelerate",
+)
 args = parser.parse_args()
+if args.load_in_8bit and args.backend != "transformers":
+    parser.error("--load-in-8bit requires --backend transformers")
 
 if args.verbose:
     logger.configure(
@@ -70,20 +93,149 @@ else:
 
 logger.info("Starting Thoth...")
 
-# Get the TOKEN for logging in the bot
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
-logger.info("Loading model...")
-whisper = WhisperModel(
-    "large-v3",
-    device="auto",
-    compute_type="int8",
-    cpu_threads=8,
-    num_workers=8,
+# Get the TOKEN for logging in the bot, falling back to the TOKEN.txt file
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or (
+    Path("TOKEN.txt").read_text() if Path("TOKEN.txt").exists() else ""
 )
+TOKEN = TOKEN.strip()
+
+logger.info(f"Loading {args.backend} model...")
+if args.backend == "transformers":
+    # imported here so that the faster-whisper setup doesn't need torch
+    from utils.inference_model import whisper_inference_model
+
+    whisper = whisper_inference_model(WHISPER_SR, 30, load_in_8bit=args.load_in_8bit)
+else:
+    whisper = WhisperModel(
+        "large-v3",
+        device="auto",
+        compute_type=(
+            "int8_float16" if ctranslate2.get_cuda_device_count() else "int8"
+        ),
+        cpu_threads=8,
+        num_workers=8,
+    )
+    # batches the VAD-split chunks of the audio through the model at once
+    pipeline = BatchedInferencePipeline(model=whisper)
+    # updates are handled concurrently, but only one transcription at a time
+    # runs on the model
+    transcription_semaphore = asyncio.Semaphore(1)
 logger.info("Model loaded")
 
 
+async def send_transcription(update: Update, transcription: str) -> None:
+    """
+    Send a piece of transcription as one or more messages
+    """
+    for msg in split_string(transcription):
+        logger.info(f"{update.message.from_user.username}: {msg}")
+        if msg.strip() not in [
+            "Sottotitoli e revisione a cura di QTSS",
+            "Sottotitoli creati dalla comunità Amara.org",
+        ]:
+            try:
+                await update.message.reply_text(
+                    msg,
+                    disable_notification=True,
+                )
+                logger.success("Message sent")
+            except Exception as e:
+                logger.error(e)
+                await update.message.reply_text(
+                    "error",
+                    disable_notification=True,
+                )
+        else:
+            await update.message.reply_text(
+                "...",
+                disable_notification=True,
+            )
+            logger.success(f"{update.message.from_user.username}: sent '...'")
+
+
+def transcribe(audio) -> Iterator[str]:
+    """
+    Transcribe a 16kHz mono signal, yielding the text of the segments as they
+    are decoded
+    """
+    start_time = time.time()
+    logger.info("Transcribing...")
+    if args.backend == "transformers":
+        yield from whisper.transcribe(audio)
+    else:
+        segments, info = pipeline.transcribe(audio, batch_size=16, beam_size=1)
+        logger.info(
+            "Detected language '%s' with probability %f"
+            % (info.language, info.language_probability)
+        )
+        # the segments are decoded lazily, one batch at a time, while iterating
+        for segment in segments:
+            yield segment.text
+    logger.info("Transcription completed in %f seconds" % (time.time() - start_time))
+
+
+async def reply_transcription(update: Update, audio) -> None:
+    """
+    Transcribe a 16kHz mono signal, sending the text to the user as the
+    segments are decoded instead of all at the end.
+    The text is flushed once it exceeds 3500 characters or every 5 seconds.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    # set when the handler gives up, the thread can't be cancelled from here
+    stop = threading.Event()
+
+    def produce() -> None:
+        # runs in a worker thread and hands every segment to the handler,
+        # None marks the end of the transcription
+        try:
+            for text in transcribe(audio):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def run_producer() -> None:
+        # only the model is serialized, the messages are sent outside the lock
+        if args.backend == "transformers":
+            # whisper_inference_model runs every generate on its own thread
+            await asyncio.to_thread(produce)
+        else:
+            async with transcription_semaphore:
+                await asyncio.to_thread(produce)
+
+    producer = asyncio.create_task(run_producer())
+
+    buffer = ""
+    sent = False
+    last_flush = None
+    try:
+        while (text := await queue.get()) is not None:
+            if last_flush is None:
+                # the time spent waiting for the model doesn't count
+                last_flush = time.monotonic()
+            buffer += text
+            if buffer.strip() and (
+                len(buffer) > 3500 or time.monotonic() - last_flush > 5
+            ):
+                await send_transcription(update, buffer)
+                buffer = ""
+                sent = True
+                last_flush = time.monotonic()
+    finally:
+        # if sending failed, stop the transcription at the next segment and
+        # wait for the thread to leave the model before propagating the error.
+        # asyncio.wait doesn't cancel the producer if the handler is cancelled,
+        # which would release the semaphore with the model still running
+        stop.set()
+        await asyncio.wait([producer])
+    # raises if the transcription failed
+    await producer
+    if buffer.strip() or not sent:
+        await send_transcription(update, buffer.strip() or "...")
+
+
 # Define a few command handlers. These usually take the two arguments update and context.
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -160,83 +312,49 @@ async def stt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Save the user
     save_user(update)
 
-    try:
-        file_id = update.message.video_note.file_id
-
-        try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                logger.info(temp_dir)
-
-                new_file = await context.bot.get_file(file_id)
-                file_video_path = os.path.join(temp_dir, "temp_video.mp4")
-                await new_file.download_to_drive(file_video_path)
-                video = VideoFileClip(file_video_path)
-        except Exception as e:
-            # if os.path.exists(temp_dir):
-            #     shutil.rmtree(temp_dir)
-            # TODO: handle this exception.
-            # The code work even there is this error.
-            logger.warning(
-                "⚠️ TODO: handle this exception: error with temporary directory ⚠️"
-            )
+    file_id, message_type = get_message_info(update)
 
-        audio = video.audio
+    try:
+        new_file = await context.bot.get_file(file_id)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            file_audio_path = os.path.join(temp_dir, "temp_audio.ogg")
-            audio.write_audiofile(file_audio_path, verbose=False, logger=None)
+        if message_type == "video_note":
+            try:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    logger.info(temp_dir)
+
+                    file_video_path = os.path.join(temp_dir, "temp_video.mp4")
+                    await new_file.download_to_drive(file_video_path)
+                    video = VideoFileClip(file_video_path)
+            except Exception as e:
+                # if os.path.exists(temp_dir):
+                #     shutil.rmtree(temp_dir)
+                # TODO: handle this exception.
+                # The code work even there is this error.
+                logger.warning(
+                    "⚠️ TODO: handle this exception: error with temporary directory ⚠️"
+                )
 
-            audio, sr = librosa.load(file_audio_path)
+            audio = video.audio
 
-    except AttributeError as e:
-        file_id = update.message.voice.file_id
+            with tempfile.TemporaryDirectory() as temp_dir:
+                file_audio_path = os.path.join(temp_dir, "temp_audio.ogg")
+                await asyncio.to_thread(
+                    audio.write_audiofile, file_audio_path, verbose=False, logger=None
+                )
 
-        new_file = await context.bot.get_file(file_id)
+                audio = await asyncio.to_thread(load_audio, file_audio_path)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            file_path = os.path.join(temp_dir, "temp_audio.mp3")
-            await new_file.download_to_drive(file_path)
-            start_time = time.time()
-            logger.info("Transcribing...")
-            segments, info = whisper.transcribe(file_path, beam_size=5, vad_filter=True)
-            logger.info(
-                "Detected language '%s' with probability %f"
-                % (info.language, info.language_probability)
-            )
-            transcription = "".join([segment.text for segment in segments])
-            logger.info(
-                "Transcription completed in %f seconds" % (time.time() - start_time)
-            )
+        else:
+            data = await new_file.download_as_bytearray()
+            audio = await asyncio.to_thread(decode_audio, bytes(data))
 
     except Exception as e:
         logger.error(f"Problema con il caricamento del file:\n{e}")
+        await update.message.reply_text(str(e))
+        return
 
     try:
-        msgs_list = split_string(transcription)
-        for msg in msgs_list:
-            logger.info(f"{update.message.from_user.username}: {msg}")
-            if msg.strip() not in [
-                "Sottotitoli e revisione a cura di QTSS",
-                "Sottotitoli creati dalla comunità Amara.org",
-            ]:
-                try:
-                    await update.message.reply_text(
-                        msg,
-                        disable_notification=True,
-                    )
-                    logger.success("Message sent")
-                except Exception as e:
-                    logger.error(e)
-                    await update.message.reply_text(
-                        "error",
-                        disable_notification=True,
-                    )
-            else:
-                await update.message.reply_text(
-                    "...",
-                    disable_notification=True,
-                )
-                logger.success(f"{update.message.from_user.username}: sent '...'")
+        await reply_transcription(update, audio)
 
     except Exception as e:
         logger.error(e)
@@ -279,26 +397,15 @@ async def ytt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 stream = ffmpeg.output(stream, temp_dir + "/output.wav")
 
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                download_from_url(url)
-                start_time = time.time()
-                segments, info = whisper.transcribe(
-                    temp_dir + "/output.wav", beam_size=5, vad_filter=True
-                )
-                logger.info(
-                    "Detected language '%s' with probability %f"
-                    % (info.language, info.language_probability)
-                )
-                transcription = "".join([segment.text for segment in segments])
-                logger.info(
-                    "Transcription completed in %f seconds" % (time.time() - start_time)
-                )
-                await update.message.reply_text(transcription)
+                await asyncio.to_thread(download_from_url, url)
+                audio = await asyncio.to_thread(load_audio, temp_dir + "/output.wav")
+                await reply_transcription(update, audio)
 
 
 def main() -> None:
     """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).concurrent_updates(True).build()
     logger.info("Application is running")
 
     # on different commands - answer in Telegram
@@ -1,20 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
 import numpy as np
 import torch
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+from loguru import logger
 from scipy.signal import resample
-from transformers import WhisperForConditionalGeneration, WhisperProcessor
+from transformers import (
+    BitsAndBytesConfig,
+    WhisperForConditionalGeneration,
+    WhisperProcessor,
+)
 
 
 class whisper_inference_model:
-    def __init__(self, new_sample_rate, seconds_per_chunk):
+    def __init__(
+        self,
+        new_sample_rate,
+        seconds_per_chunk,
+        batch_size=8,
+        load_in_8bit=False,
+        model_name="openai/whisper-large-v2",
+    ):
+        """
+        Whisper running on HuggingFace transformers, used by `--backend transformers`.
+        `load_in_8bit` requires the optional `bitsandbytes` and `accelerate`
+        packages, which are not part of the requirements.
+        """
+        # both Whisper's feature extractor and the Silero VAD work at 16kHz
+        if new_sample_rate != 16000:
+            raise ValueError(
+                f"Whisper needs 16000 Hz audio, got new_sample_rate={new_sample_rate}"
+            )
         self.new_sr = new_sample_rate
         self.samples_per_chunk = seconds_per_chunk * self.new_sr
-        self.model_name = "openai/whisper-large-v2"
+        # same VAD settings as faster-whisper's BatchedInferencePipeline, the
+        # speech regions are split so that none is longer than a chunk
+        self.vad_options = VadOptions(
+            max_speech_duration_s=seconds_per_chunk, min_silence_duration_ms=160
+        )
+        # number of chunks sent to the model at once, bounds the VRAM usage
+        self.batch_size = batch_size
+        self.model_name = model_name
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        self.model = WhisperForConditionalGeneration.from_pretrained(
-            self.model_name
-        ).to(self.device)
+        self.dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        # 8-bit weights (bitsandbytes) halve the bytes read by every decoder step
+        self.load_in_8bit = load_in_8bit and self.device.type == "cuda"
+        if load_in_8bit and not self.load_in_8bit:
+            logger.warning("load_in_8bit needs a CUDA device, loading the model in float32")
+        if self.load_in_8bit:
+            self.model = WhisperForConditionalGeneration.from_pretrained(
+                self.model_name,
+                attn_implementation="sdpa",
+                torch_dtype=self.dtype,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map="auto",
+            )
+        else:
+            self.model = WhisperForConditionalGeneration.from_pretrained(
+                self.model_name, attn_implementation="sdpa", torch_dtype=self.dtype
+            ).to(self.device)
         self.processor = WhisperProcessor.from_pretrained(self.model_name)
-        self.model.config.forced_decoder_ids = self.processor.get_decoder_prompt_ids(
+        # the feature extractor holds the mel filterbank, computed only once
+        self.feature_extractor = self.processor.feature_extractor
+        # greedy decoding, capped to what Whisper can emit for a single window
+        self.generate_kwargs = dict(
             language="it",
             task="transcribe",
+            num_beams=1,
+            do_sample=False,
+            max_new_tokens=440,
+            use_cache=True,
         )
+        if self.device.type == "cuda":
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+        # every generate runs on this single thread: it serializes the model
+        # across users, and the CUDA graphs recorded by the warmup are kept per
+        # thread, so the requests must run where the warmup did
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # the bitsandbytes int8 matmuls don't go through torch.compile
+        self.compiled = self.device.type == "cuda" and not self.load_in_8bit
+        if self.compiled:
+            # with a static KV cache on CUDA, generate compiles the decoding step
+            # itself and its shapes stay fixed, so the graphs are recorded once
+            self.model.generation_config.cache_implementation = "static"
+            self.warmup()
+
+    def warmup(self) -> None:
+        """
+        Run a dummy generation at the batch shape used by `transcribe`, so the
+        first request doesn't pay the compilation
+        """
+        input_features = torch.zeros(
+            self.batch_size, self.model.config.num_mel_bins, 3000
+        )
+        # the second run covers the prefill on the already allocated static cache
+        for _ in range(2):
+            self.generate(input_features)
+
+    def generate(self, input_features: torch.Tensor) -> torch.Tensor:
+        """
+        Run the model on a batch of input features, on the model thread
+        """
+        return self.executor.submit(self._generate, input_features).result()
+
+    def _generate(self, input_features: torch.Tensor) -> torch.Tensor:
+        input_features = input_features.to(
+            self.device, dtype=self.dtype, non_blocking=True
+        )
+        num_chunks = input_features.shape[0]
+        if self.compiled and num_chunks < self.batch_size:
+            # keep the compiled batch shape, repeating the last chunk so the
+            # padding doesn't decode longer than the real chunks
+            input_features = torch.cat(
+                [
+                    input_features,
+                    input_features[-1:].expand(self.batch_size - num_chunks, -1, -1),
+                ]
+            )
+        with torch.inference_mode():
+            predicted_ids = self.model.generate(input_features, **self.generate_kwargs)
+        return predicted_ids[:num_chunks]
+
+    def get_chunks(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Group the consecutive speech regions found by the Silero VAD model in
+        chunks of at most `seconds_per_chunk` seconds, so that no word is cut
+        between two chunks. Returned as a zero padded
+        (num_chunks, samples_per_chunk) array.
+        """
+        win = self.samples_per_chunk
+        groups = []
+        group_len = win
+        for ts in get_speech_timestamps(audio, self.vad_options):
+            region = audio[ts["start"] : ts["end"]][:win]
+            if group_len + len(region) > win:
+                groups.append([])
+                group_len = 0
+            groups[-1].append(region)
+            group_len += len(region)
+        chunks = np.zeros((len(groups), win), dtype=audio.dtype)
+        for chunk, regions in zip(chunks, groups):
+            speech = np.concatenate(regions)
+            chunk[: len(speech)] = speech
+        return chunks
+
+    def transcribe(self, audio: np.ndarray) -> Iterator[str]:
+        """
+        Transcribe the audio, running the chunks through the model in batches
+        of `batch_size` and yielding the text of every batch as it is decoded.
+        """
+        chunks = self.get_chunks(audio)
+        for i in range(0, len(chunks), self.batch_size):
+            input_features = self.feature_extractor(
+                chunks[i : i + self.batch_size],
+                return_tensors="pt",
+                sampling_rate=self.new_sr,
+                return_attention_mask=False,
+            ).input_features
+            if self.device.type == "cuda":
+                # pinned memory lets the copy overlap with the running kernels
+                input_features = input_features.pin_memory()
+            predicted_ids = self.generate(input_features)
+            transcriptions = self.processor.tokenizer.batch_decode(
+                predicted_ids, skip_special_tokens=True
+            )
+            yield " " + " ".join(t.strip() for t in transcriptions)
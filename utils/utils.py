@@ -1,29 +1,44 @@
 from datetime import timedelta
 from typing import List
 
-import librosa
+import ffmpeg
 import numpy as np
+import soundfile as sf
+import soxr
 from loguru import logger
 
+WHISPER_SR = 16000
 
-def split_string(string: str) -> List[str]:
+
+def split_string(string: str, limit: int = 4096) -> List[str]:
     """
-    Split a string into a list of strings of length < 4096.
+    Split a string into a list of strings of length <= limit.
     :param string: the string to split
+    :param limit: the maximum length of every string
     :return: a list of strings
     """
-    if len(string) < 4096:
+    if len(string) <= limit:
         yield string
         return
-    words = string.split()
-    current_string = ""
-    for word in words:
-        if len(current_string) + len(word) > 4095:
-            yield current_string
-            current_string = word
-        else:
-            current_string += f" {word}"
-    yield current_string
+    buf = []
+    buflen = 0
+    for word in string.split():
+        # a single word longer than the limit is split on characters
+        while len(word) > limit:
+            if buf:
+                yield " ".join(buf)
+                buf = []
+                buflen = 0
+            yield word[:limit]
+            word = word[limit:]
+        if buf and buflen + len(word) + 1 > limit:
+            yield " ".join(buf)
+            buf = []
+            buflen = 0
+        buflen += len(word) + 1 if buf else len(word)
+        buf.append(word)
+    if buf:
+        yield " ".join(buf)
 
 
 def format_timedelta(td: timedelta) -> str:
@@ -33,16 +48,16 @@ def format_timedelta(td: timedelta) -> str:
     days = td.days
     hours, remainder = divmod(td.seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
-    result = []
-    if days > 0:
-        result.append(f"{days} days")
-    if hours > 0:
-        result.append(f"{hours} hours")
-    if minutes > 0:
-        result.append(f"{minutes} minutes")
-    if seconds > 0:
-        result.append(f"{seconds} seconds")
-    return " e ".join(result)
+    return " e ".join(
+        part
+        for part in (
+            f"{days} days" if days > 0 else "",
+            f"{hours} hours" if hours > 0 else "",
+            f"{minutes} minutes" if minutes > 0 else "",
+            f"{seconds} seconds" if seconds > 0 else "",
+        )
+        if part
+    )
 
 
 def detect_silence(audio: np.ndarray, sr: int, threshold: int = 70) -> int:
@@ -57,27 +72,52 @@ def detect_silence(audio: np.ndarray, sr: int, threshold: int = 70) -> int:
         Tuple[int, float]: A tuple containing the number of half seconds of total silence at the end of the audio file and the duration of the audio file in seconds.
     """
     try:
-        duration = librosa.get_duration(y=audio, sr=sr) * 1000  # in milliseconds
-        seconds = []
-
-        # transform the amplitude of the audio signal into decibels for every 0.5 seconds
-        for s in range(0, len(audio), int(sr)):
-            seconds.append(np.abs(audio[s : s + int(sr)]).sum())
-
-        seconds = seconds[::-1]
-
-        count = 0
-        for s in seconds:
-            if s < threshold:
-                count += 1
-            else:
-                break
-        return count, duration / 1000
+        sr = int(sr)
+        duration = len(audio) / sr
+        n = (len(audio) // sr) * sr
+
+        # sum the absolute amplitude of the audio signal for every second
+        energies = np.abs(audio[:n]).reshape(-1, sr).sum(axis=1)
+        if n < len(audio):
+            energies = np.append(energies, np.abs(audio[n:]).sum())
+
+        loud = energies[::-1] >= threshold
+        count = int(np.argmax(loud)) if loud.any() else len(energies)
+        return count, duration
     except Exception as e:
         logger.exception(e)
         raise e
 
 
+def load_audio(file_path: str, sr: int = WHISPER_SR) -> np.ndarray:
+    """
+    Load an audio file as a mono float32 signal resampled to `sr`
+    """
+    audio, file_sr = sf.read(file_path, dtype="float32", always_2d=False)
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1, dtype=np.float32)
+    if file_sr != sr:
+        audio = soxr.resample(audio, file_sr, sr)
+    return audio
+
+
+def decode_audio(data: bytes, sr: int = WHISPER_SR) -> np.ndarray:
+    """
+    Decode an in-memory audio file (e.g. a Telegram OGG/Opus voice message)
+    into a mono float32 signal at `sr`, piping it through ffmpeg
+    """
+    try:
+        out, _ = (
+            ffmpeg.input("pipe:0")
+            .output("pipe:1", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+            .run(input=data, capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        logger.error(f"ffmpeg failed to decode the audio:\n{e.stderr.decode()}")
+        raise
+    return np.frombuffer(out, dtype=np.float32)
+
+
 def get_message_info(update):
     try:
         file_id = update.message.video_note.file_id